@@ -5,9 +5,9 @@
 # Extra disclaimer: This code is just a quick personal project and is not suitable for deployment by anyone, anywhere...
 import badge
 import gc
+from array import array
 import urequests
 import ugfx
-import json
 import sys
 import utime
 
@@ -36,6 +36,9 @@ INFLUXDB_HEADERS = {
     'Content-Type': 'application/x-www-form-urlencoded'
 }
 
+POLL_SECONDS = 5  # time between InfluxDB queries
+MAX_POLL_SECONDS = 300  # longest time between queries, while they are failing
+
 def round_up(value, to_next):
     result = ((int(value) + to_next - 1) // to_next) * to_next
     return result
@@ -45,32 +48,62 @@ def unix_time():
     return utime.time() + UNIX_EPOCH_OFFSET
 
 
-class Sample(object):
-    def __init__(self, ts, min_solar, max_solar, min_usage, max_usage):
-        self.ts = int(ts)
-        self.solar = None if min_solar is None else (min_solar, max_solar)
-        self.usage = None if min_usage is None else (min_usage, max_usage)
+def poll_delay(failures):
+    # back off exponentially while queries fail, rather than hammering a server or network that is down
+    return min(POLL_SECONDS << min(failures, 8), MAX_POLL_SECONDS)
 
-    def __repr__(self):
-        return '{}: {} / {}'.format(self.ts, self.solar, self.usage)
 
-    def is_empty(self):
-        return self.solar is None and (self.usage is None or self.usage == (0, 0))
+NO_DATA = -1e9  # stored in Samples arrays in place of a missing solar or usage value
 
-    def max_power(self):
-        return max(self.solar[1] if self.solar else 0, self.usage[1] if self.usage else 0)
 
-    def update_time(self):
-        # Lazy global timekeeping: Maintain the RTC clock from InfluxDB results,
-        # assuming that the latest sample we get back should be less than 10 seconds
-        # in the past (provided that samples are being updated...)
-        #
-        # TODO: support InfluxDB auth (eek!)
-        if rtc:
-            unix_ts = self.ts - UNIX_EPOCH_OFFSET
-            if unix_ts > utime.time() + 5:  # to save on overhead, need to be adjusting by more than 5 seconds
-                rtc.init(utime.gmtime(unix_ts))
-                print('New time is {} {}'.format(unix_time(), utime.gmtime(int(utime.time()))))
+class Samples(object):
+    """
+    A set of samples, stored as one array per column rather than one object per sample
+
+    The solar & usage columns hold NO_DATA when InfluxDB had no value for that time.
+    """
+    def __init__(self, size=0):
+        no_data = [NO_DATA] * size
+        self.ts = array('i', [0] * size)
+        self.solar_min = array('f', no_data)
+        self.solar_max = array('f', no_data)
+        self.usage_min = array('f', no_data)
+        self.usage_max = array('f', no_data)
+        self.power_columns = (self.solar_min, self.solar_max, self.usage_min, self.usage_max)
+
+    def __len__(self):
+        return len(self.ts)
+
+    def append(self, ts, min_solar, max_solar, min_usage, max_usage):
+        self.ts.append(int(ts))
+        if min_solar is None:
+            min_solar = max_solar = NO_DATA
+        if min_usage is None:
+            min_usage = max_usage = NO_DATA
+        self.solar_min.append(min_solar)
+        self.solar_max.append(max_solar)
+        self.usage_min.append(min_usage)
+        self.usage_max.append(max_usage)
+
+    def max_power(self, idx):
+        return max(self.solar_max[idx], self.usage_max[idx], 0)
+
+
+def is_empty(min_solar, min_usage, max_usage):
+    return min_solar is None and (min_usage is None or (min_usage == 0 and max_usage == 0))
+
+
+def update_time(ts):
+    # Lazy global timekeeping: Maintain the RTC clock from InfluxDB results,
+    # assuming that the latest sample we get back should be less than 10 seconds
+    # in the past (provided that samples are being updated...)
+    #
+    # TODO: support InfluxDB auth (eek!)
+    if rtc:
+        unix_ts = ts - UNIX_EPOCH_OFFSET
+        if unix_ts > utime.time() + 5:  # to save on overhead, need to be adjusting by more than 5 seconds
+            rtc.init(utime.gmtime(unix_ts))
+            print('New time is {} {}'.format(unix_time(), utime.gmtime(int(utime.time()))))
 
 
 class NumberDisplay(object):
@@ -83,15 +116,28 @@ class NumberDisplay(object):
 
     def __init__(self):
         self.num_updates = 0
-        self.last_sample = None
+        self._dirty = False  # drawn since the last flush
+        self._full_refresh = False  # next flush uses the full refresh waveform
+        self._solar_text = self._usage_text = None  # text currently drawn for each number
         self.redraw_display()
 
+    def _flush(self):
+        if self._dirty:
+            if self._full_refresh:
+                ugfx.flush(ugfx.LUT_FULL)
+                self._full_refresh = False
+            else:
+                ugfx.flush()
+            self._dirty = False
+
     def redraw_display(self):
-        for _ in range(3 if self.num_updates == self.REDRAW_UPDATES else 1):
-            ugfx.area(0, 0, WIDTH, LINE_Y, ugfx.BLACK)
-            ugfx.flush()
-            ugfx.area(0, 0, WIDTH, LINE_Y, ugfx.WHITE)
-            ugfx.flush()
+        self._redraw()
+        self._flush()
+
+    def _redraw(self):
+        # the full refresh LUT cycles the eink pixels in the controller, instead of flushing black & white frames
+        ugfx.area(0, 0, WIDTH, LINE_Y, ugfx.WHITE)
+        self._full_refresh = True
 
         # line under the display, icons
         ugfx.line(0, LINE_Y, WIDTH - 1, LINE_Y, ugfx.BLACK)
@@ -102,31 +148,41 @@ class NumberDisplay(object):
 
         ugfx.display_image(0, 0, '{}/sun.png'.format(path))
         ugfx.display_image(130, 0, '{}/house.png'.format(path))
-        ugfx.flush()
+        self._solar_text = self._usage_text = None
+        self._dirty = True
 
-    def update(self, sample):
-        self.last_sample = sample
+    def update(self, samples, idx):
+        # show sample number idx from samples
 
-        def as_text(value):
-            return '  -' if value is None else '{:.1f}W'.format((value[0] + value[1])/2)
+        def as_text(min_value, max_value):
+            return '  -' if min_value == NO_DATA else '{:.1f}W'.format((min_value + max_value)/2)
 
         if self.num_updates == self.REDRAW_UPDATES:
-            self.redraw_display()  # do a full refresh
+            self._redraw()  # do a full refresh
             self.num_updates = 0
         else:
             self.num_updates += 1
 
-        self._draw(as_text(sample.solar), as_text(sample.usage))
+        self._draw(as_text(samples.solar_min[idx], samples.solar_max[idx]),
+                   as_text(samples.usage_min[idx], samples.usage_max[idx]))
+        self._flush()
 
     def update_no_sample(self):
         self._draw('???', '???')
+        self._flush()
 
     def _draw(self, solar_text, usage_text):
-        ugfx.area(36, 4, 130-36, 32-4, ugfx.WHITE)
-        ugfx.area(166, 4, WIDTH-166, 32-4, ugfx.WHITE)
-        ugfx.string(36, 4, solar_text, 'Roboto_Regular22', ugfx.BLACK)
-        ugfx.string(166, 4, usage_text, 'Roboto_Regular22', ugfx.BLACK)
-        ugfx.flush()
+        # only redraw the numbers whose text changed, so an unchanged reading doesn't refresh the display
+        if solar_text != self._solar_text:
+            ugfx.area(36, 4, 130-36, 32-4, ugfx.WHITE)
+            ugfx.string(36, 4, solar_text, 'Roboto_Regular22', ugfx.BLACK)
+            self._solar_text = solar_text
+            self._dirty = True
+        if usage_text != self._usage_text:
+            ugfx.area(166, 4, WIDTH-166, 32-4, ugfx.WHITE)
+            ugfx.string(166, 4, usage_text, 'Roboto_Regular22', ugfx.BLACK)
+            self._usage_text = usage_text
+            self._dirty = True
 
 
 class Graph(object):
@@ -136,17 +192,115 @@ class Graph(object):
     X_WIDTH = WIDTH-LINE_X
     Y_HEIGHT = XAXIS_Y-LINE_Y-2
     UPDATES_FULL_REFRESH = 3
+    PARTIAL_UPDATES_FULL_REFRESH = 200  # cycle the eink after this many partial column redraws, to clear ghosting
 
     WIDTH_SECONDS = 60 * 60  # width of graph in seconds
     SECONDS_PER_PIXEL = int(WIDTH_SECONDS / X_WIDTH)  # this many seconds per pixel (float)
+    NUM_BUCKETS = WIDTH_SECONDS // SECONDS_PER_PIXEL + 1  # ring buffer slots, one per InfluxDB group in the window
 
     def __init__(self):
         self.num_updates = 0
         self.last_x = None
         self.last_usage_y = None
-        self.samples = []
         self.max_power = None
+        self._y_scale = None  # pixels per watt, Y_HEIGHT / max_power
         self.origin_ts = None  # timestamp that correlates to the left-hand side of the graph, update() will recalc it
+        self._dirty = False  # drawn since the last flush
+        self._full_refresh = False  # next flush uses the full refresh waveform
+
+        # Samples are kept in a fixed size ring buffer, one slot per SECONDS_PER_PIXEL bucket. The slot for
+        # a sample is (ts // SECONDS_PER_PIXEL) % NUM_BUCKETS, head_bucket is the oldest bucket in the window.
+        # Empty slots have ts 0.
+        self._buf = Samples(self.NUM_BUCKETS)
+        self._head_bucket = None
+        self._num_samples = 0
+
+        # Timestamps & max power of samples in the window with strictly decreasing max power, oldest first.
+        # The first entry is the largest max power in the window.
+        self._max_ts = []
+        self._max_power = []
+
+        # y coordinates of each ring buffer slot at the current scale, and as last drawn on the display:
+        # solar min, solar max, usage min, usage max (-1 if none)
+        self._buf_y = array('h', [-1] * (4 * self.NUM_BUCKETS))
+        self._drawn_y = array('h', [-1] * (4 * self.NUM_BUCKETS))
+        self._num_partial_updates = 0
+        self._last_drawn_bucket = None  # newest bucket drawn on the display, nothing is drawn to the right of it
+        self._x_labels = {}  # X axis label text by minute, the graph scrolls in steps so only a few are ever used
+        self._y_ticks = None  # (from_x, y, label or None) for each Y axis tick, recalculated when max_power changes
+
+    def _scroll(self, origin_ts):
+        # Move the head of the ring buffer to the first bucket at or after origin_ts, evicting older samples
+        spp = self.SECONDS_PER_PIXEL
+        n = self.NUM_BUCKETS
+        new_head = (origin_ts + spp - 1) // spp
+        old_head = self._head_bucket
+        self._head_bucket = new_head
+        if old_head is None or new_head == old_head:
+            return
+        if new_head < old_head or new_head - old_head >= n:
+            # clock went backwards, or scrolled past the whole window: start again
+            evict = range(n)
+        else:
+            evict = range(old_head, new_head)
+        buf_ts = self._buf.ts
+        for bucket in evict:
+            if buf_ts[bucket % n]:
+                buf_ts[bucket % n] = 0
+                self._num_samples -= 1
+
+        max_ts = self._max_ts
+        head_ts = new_head * spp
+        k = 0
+        if new_head < old_head:
+            k = len(max_ts)
+        while k < len(max_ts) and max_ts[k] < head_ts:
+            k += 1
+        if k:
+            del max_ts[:k]
+            del self._max_power[:k]
+
+    def _insert(self, samples, i):
+        # Store sample number i of samples in the ring buffer, replacing any existing sample in the same bucket.
+        # Returns the sample's bucket, or None if it is outside the graph window.
+        ts = samples.ts[i]
+        bucket = ts // self.SECONDS_PER_PIXEL
+        if bucket < self._head_bucket or bucket >= self._head_bucket + self.NUM_BUCKETS:
+            return None
+        idx = bucket % self.NUM_BUCKETS
+        buf = self._buf
+        if not buf.ts[idx]:
+            self._num_samples += 1
+        buf.ts[idx] = ts
+        buf.solar_min[idx] = samples.solar_min[i]
+        buf.solar_max[idx] = samples.solar_max[i]
+        buf.usage_min[idx] = samples.usage_min[i]
+        buf.usage_max[idx] = samples.usage_max[i]
+
+        power = buf.max_power(idx)
+        max_ts = self._max_ts
+        if max_ts and (max_ts[-1] > ts or (max_ts[-1] == ts and self._max_power[-1] > power)):
+            # out of order sample, or a bucket's max went down: rebuild the deque from scratch
+            del max_ts[:]
+            del self._max_power[:]
+            n = self.NUM_BUCKETS
+            for b in range(self._head_bucket, self._head_bucket + n):
+                if buf.ts[b % n]:
+                    self._push_max(buf.ts[b % n], buf.max_power(b % n))
+        else:
+            self._push_max(ts, power)
+        return bucket
+
+    def _push_max(self, ts, power):
+        # Samples arrive in time order, so any older sample with no more power can never be the max again.
+        # A new sample for the latest bucket replaces the previous one (the bucket max usually only grows.)
+        max_ts = self._max_ts
+        max_power = self._max_power
+        while max_ts and (max_ts[-1] >= ts or max_power[-1] <= power):
+            max_ts.pop()
+            max_power.pop()
+        max_ts.append(ts)
+        max_power.append(power)
 
     def timestamp_to_x(self, ts):
         r = ((ts - self.origin_ts) * self.X_WIDTH) // self.WIDTH_SECONDS
@@ -157,54 +311,69 @@ class Graph(object):
         if value < 0:
             value = 0  # some kind of influx bug causes occasional negative minimums?
         assert value < self.max_power
-        result = (value / self.max_power) * self.Y_HEIGHT
+        result = value * self._y_scale
         result = max(result, 1)
         return self.Y_HEIGHT - int(result) + LINE_Y
 
-    def redraw_display(self):
+    def _flush(self):
+        if self._dirty:
+            if self._full_refresh:
+                ugfx.flush(ugfx.LUT_FULL)
+                self._full_refresh = False
+            else:
+                ugfx.flush()
+            self._dirty = False
+
+    def _redraw(self, full_refresh=False):
         # draw the X & Y axis lines
         self.num_updates += 1
-        if self.num_updates == self.UPDATES_FULL_REFRESH:
-            # cycle the eink display to refresh the pixels
+        if full_refresh or self.num_updates == self.UPDATES_FULL_REFRESH:
+            # flush the new graph with the full refresh LUT, which cycles the eink pixels to clear ghosting
             self.num_updates = 0
-            for _ in range(3):
-                ugfx.area(0, LINE_Y+1, WIDTH, HEIGHT-LINE_Y-1, ugfx.BLACK)
-                ugfx.flush()
-                ugfx.area(0, LINE_Y+1, WIDTH, HEIGHT-LINE_Y-1, ugfx.WHITE)
-                ugfx.flush()
-        else:
-            # in between, just draw the display white one time
-            ugfx.area(0, LINE_Y+1, WIDTH, HEIGHT-LINE_Y-1, ugfx.WHITE)
-            ugfx.flush()
+            self._num_partial_updates = 0
+            self._full_refresh = True
+        ugfx.area(0, LINE_Y+1, WIDTH, HEIGHT-LINE_Y-1, ugfx.WHITE)
 
         ugfx.line(LINE_X, LINE_Y, LINE_X, XAXIS_Y, ugfx.BLACK)
         ugfx.line(0, XAXIS_Y, WIDTH-1, XAXIS_Y, ugfx.BLACK)
-        ugfx.flush()
+        self._dirty = True
 
         self.redraw_y_axis()
         self.redraw_x_axis()
 
         self.last_x = None
         self.last_usage_y = None
+        drawn_y = self._drawn_y
+        for c in range(len(drawn_y)):
+            drawn_y[c] = -1
+        self._last_drawn_bucket = None
 
-        if not self.samples:
+        if not self._num_samples:
             self.origin_ts = None
             return  # nothing else to draw, leave the X axis and graph area blank
 
-        self.draw_samples(self.samples)  # draw the full graph!
+        buf_ts = self._buf.ts
+        for i in range(self.NUM_BUCKETS):
+            if buf_ts[i]:
+                self._calc_y(i)
+        self.draw_samples(self._head_bucket, self._head_bucket + self.NUM_BUCKETS - 1)  # draw the full graph!
 
     def redraw_y_axis(self):
-        steps = 6
-        watts_per_step = self.max_power / steps
-        for step in range(steps):
-            y = self.value_to_y(step * watts_per_step)
-            if step % 2 == 1:
-                from_x = LINE_X - 2
-                ugfx.string(0, y - 6, '{:.1f}'.format(step * watts_per_step / 1000), 'Roboto_Regular12', ugfx.BLACK)
-            else:
-                from_x = LINE_X - 5
+        if self._y_ticks is None:
+            steps = 6
+            watts_per_step = self.max_power / steps
+            ticks = []
+            for step in range(steps):
+                y = self.value_to_y(step * watts_per_step)
+                if step % 2 == 1:
+                    ticks.append((LINE_X - 2, y, '{:.1f}'.format(step * watts_per_step / 1000)))
+                else:
+                    ticks.append((LINE_X - 5, y, None))
+            self._y_ticks = ticks
+        for from_x, y, label in self._y_ticks:
+            if label is not None:
+                ugfx.string(0, y - 6, label, 'Roboto_Regular12', ugfx.BLACK)
             ugfx.line(from_x, y, LINE_X, y, HEIGHT-1)
-        ugfx.flush()
 
     def redraw_x_axis(self):
         if self.origin_ts is None:
@@ -215,77 +384,234 @@ class Graph(object):
             x = self.timestamp_to_x(ts)
             ugfx.line(x, XAXIS_Y, x, HEIGHT - 4, ugfx.BLACK)
             minutes = (ts // 60) % 60
-            ugfx.string(x + 2, XAXIS_Y, ':{:02}'.format(minutes), 'Roboto_Regular12', ugfx.BLACK)
-            ugfx.flush()
+            label = self._x_labels.get(minutes)
+            if label is None:
+                label = self._x_labels[minutes] = ':{:02}'.format(minutes)
+            ugfx.string(x + 2, XAXIS_Y, label, 'Roboto_Regular12', ugfx.BLACK)
             ts += self.WIDTH_SECONDS // NUM_SEGMENTS
 
+    def _new_origin(self):
+        # timestamp for the left-hand side of the graph at the current time
+        SCROLL_SECONDS = self.WIDTH_SECONDS // 4
+        return round_up(unix_time(), SCROLL_SECONDS) - self.WIDTH_SECONDS
+
+    def update_no_sample(self):
+        # no new samples, so only scroll the graph if it's time to
+        if self.origin_ts is not None and self._new_origin() != self.origin_ts:
+            self.update(Samples())
+
     def update(self, samples):
         # check for a scroll event
-        SCROLL_SECONDS = self.WIDTH_SECONDS // 4
-        new_origin = round_up(unix_time(), SCROLL_SECONDS) - self.WIDTH_SECONDS
+        new_origin = self._new_origin()
         if new_origin != self.origin_ts:
             print('graph timestamp range {} - {} ({} seconds)'.format(
                 new_origin, new_origin + self.WIDTH_SECONDS, self.WIDTH_SECONDS))
-        while self.samples and self.samples[0].ts < new_origin:
-            del self.samples[0]
-
-        for new_sample in samples:
-            # add the new samples to the current list of samples
-            if new_sample.ts < new_origin:
-                continue
-            elif self.samples and self.samples[-1].ts >= new_sample.ts:
-                self.samples[-1] = new_sample  # some new samples are dups
-            else:
-                self.samples.append(new_sample)
-
-        if not self.samples:
+        self._scroll(new_origin)
+
+        first_bucket = last_bucket = None
+        for i in range(len(samples)):
+            # add the new samples to the ring buffer, some new samples are dups of the same bucket
+            bucket = self._insert(samples, i)
+            if bucket is not None:
+                if first_bucket is None:
+                    first_bucket = bucket
+                last_bucket = bucket
+
+        if not self._num_samples:
             return  # empty
 
-        new_max = round_up(max(s.max_power() for s in self.samples), 500)
+        new_max = round_up(self._max_power[0], 500)
         new_max += 500
         if new_origin != self.origin_ts or new_max != self.max_power:
             print('origin {} -> {} max {} -> {}, redraw!'.format(
                 self.origin_ts, new_origin, self.max_power, new_max))
             # need to draw the whole graph again!
+            if new_max != self.max_power:
+                self._y_ticks = None
             self.origin_ts = new_origin
             self.max_power = new_max
-            self.redraw_display()
-        else:
-            # just draw the new samples here, onto the existing graph
-            self.draw_samples(samples)
-
-    def draw_samples(self, samples):
-        print('Drawing {} samples'.format(len(samples)))
-
-        for s in samples:
-            x = self.timestamp_to_x(s.ts)
-
-            if s.solar:
-                solar_y_min = self.value_to_y(s.solar[0])
-                solar_y_max = self.value_to_y(s.solar[1])
-                solar_x = x - (x % 2)  # no greyscale, so draw the solar as a dotted line,
-                ugfx.line(solar_x, solar_y_min, solar_x, solar_y_max, ugfx.BLACK)
-            if s.usage:
-                usage_y_min = self.value_to_y(s.usage[0])
-                usage_y_max = self.value_to_y(s.usage[1])
-                ugfx.line(x, usage_y_min, x, usage_y_max, ugfx.BLACK)
-                # horizontally join the high points of the usage graph, if they exist
-                if self.last_x in (x - 1, x - 2):
-                    ugfx.line(self.last_x, self.last_usage_y, x, usage_y_max, ugfx.BLACK)
-                self.last_x = x
-                self.last_usage_y = usage_y_max
-        ugfx.flush()
+            self._y_scale = self.Y_HEIGHT / new_max
+            self._redraw()
+        elif first_bucket is not None:
+            # just redraw the columns where samples changed, onto the existing graph
+            if self._num_partial_updates >= self.PARTIAL_UPDATES_FULL_REFRESH:
+                print('{} partial updates, full refresh'.format(self._num_partial_updates))
+                self._redraw(full_refresh=True)
+            else:
+                self.update_samples(first_bucket, last_bucket)
+        self._flush()
+
+    def _calc_y(self, i):
+        # calculate the y coordinates of ring buffer slot i into _buf_y (value_to_y inlined, -1 if no value)
+        buf = self._buf
+        buf_y = self._buf_y
+        j = 4 * i
+        y_bottom = self.Y_HEIGHT + LINE_Y
+        y_scale = self._y_scale
+        for column in buf.power_columns:
+            v = column[i]
+            if v == NO_DATA:
+                buf_y[j] = -1
+            else:
+                if v < 0:
+                    v = 0  # some kind of influx bug causes occasional negative minimums?
+                buf_y[j] = y_bottom - int(max(v * y_scale, 1))
+            j += 1
+
+    def update_samples(self, first_bucket, last_bucket):
+        # Redraw only the graph columns where the samples from first_bucket to last_bucket differ from
+        # what is already drawn there.
+        buf = self._buf
+        n = self.NUM_BUCKETS
+        buf_y = self._buf_y
+        drawn_y = self._drawn_y
+        first_x = last_x = None
+        for bucket in range(first_bucket, last_bucket + 1):
+            i = bucket % n
+            if not buf.ts[i]:
+                continue
+            x = self.timestamp_to_x(buf.ts[i])
+            self._calc_y(i)
+            j = 4 * i
+            if (buf_y[j] != drawn_y[j] or buf_y[j + 1] != drawn_y[j + 1] or
+                    buf_y[j + 2] != drawn_y[j + 2] or buf_y[j + 3] != drawn_y[j + 3]):
+                if first_x is None:
+                    first_x = x
+                last_x = x
+        if first_x is None:
+            print('No changed samples')
+            return
+
+        # A sample draws into its own column and up to two columns to the left (solar lines are drawn on even
+        # columns, usage join lines go back to the previous sample). Erase all of those columns (except the Y axis
+        # line), then redraw every sample which draws into them, starting early enough to rejoin the usage line.
+        erase_x = max(first_x - 2, LINE_X + 1)
+        if last_x >= erase_x:
+            ugfx.area(erase_x, LINE_Y + 1, last_x - erase_x + 1, XAXIS_Y - LINE_Y - 1, ugfx.WHITE)
+            self._num_partial_updates += 1
+        head = self._head_bucket
+        while first_bucket > head and (not buf.ts[(first_bucket - 1) % n] or
+                                       self.timestamp_to_x(buf.ts[(first_bucket - 1) % n]) >= first_x - 4):
+            first_bucket -= 1
+        newest = self._last_drawn_bucket  # no need to look past the newest sample already drawn
+        while newest is not None and last_bucket < newest and (
+                not buf.ts[(last_bucket + 1) % n] or
+                self.timestamp_to_x(buf.ts[(last_bucket + 1) % n]) <= last_x + 2):
+            last_bucket += 1
+        self.last_x = None
+        self.draw_samples(first_bucket, last_bucket)
+
+    def draw_samples(self, first_bucket, last_bucket):
+        # draw the samples in the ring buffer from first_bucket to last_bucket, inclusive, using their
+        # y coordinates already calculated into _buf_y. Samples which land on the same column are merged
+        # and drawn once.
+        #
+        # This is the hot loop, so everything is bound to locals and timestamp_to_x is inlined
+        line = ugfx.line
+        pixel = ugfx.pixel
+        BLACK = ugfx.BLACK
+        buf_ts = self._buf.ts
+        buf_y = self._buf_y
+        drawn_y = self._drawn_y
+        n = self.NUM_BUCKETS
+        origin_ts = self.origin_ts
+        x_width = self.X_WIDTH
+        width_seconds = self.WIDTH_SECONDS
+        last_x = self.last_x
+        last_usage_y = self.last_usage_y
+        col_x = None
+        run_x = None
+        newest = None
+        col_solar_y_min = col_solar_y_max = col_usage_y_min = col_usage_y_max = -1
+        num_drawn = 0
+        for bucket in range(first_bucket, last_bucket + 2):
+            if bucket <= last_bucket:
+                i = bucket % n
+                ts = buf_ts[i]
+                if not ts:
+                    continue
+                r = ((ts - origin_ts) * x_width) // width_seconds
+                x = LINE_X + (0 if r < 0 else (x_width - 1 if r >= x_width else r))
+                j = 4 * i
+                for k in range(j, j + 4):
+                    drawn_y[k] = buf_y[k]
+                newest = bucket
+                if x == col_x:
+                    # same column as the previous sample, merge them. Each min (bottom) is the largest y,
+                    # each max (top) the smallest y that isn't -1
+                    col_solar_y_min = max(col_solar_y_min, buf_y[j])
+                    if buf_y[j + 1] != -1 and (col_solar_y_max == -1 or buf_y[j + 1] < col_solar_y_max):
+                        col_solar_y_max = buf_y[j + 1]
+                    col_usage_y_min = max(col_usage_y_min, buf_y[j + 2])
+                    if buf_y[j + 3] != -1 and (col_usage_y_max == -1 or buf_y[j + 3] < col_usage_y_max):
+                        col_usage_y_max = buf_y[j + 3]
+                    continue
+            else:
+                x = None  # past the last bucket, draw the final column
+
+            if col_x is not None:
+                num_drawn += 1
+                if col_solar_y_min != -1:
+                    solar_x = col_x - (col_x % 2)  # no greyscale, so draw the solar as a dotted line,
+                    if col_solar_y_min == col_solar_y_max:
+                        pixel(solar_x, col_solar_y_min, BLACK)  # flat power, cheaper than a 1 pixel line
+                    else:
+                        line(solar_x, col_solar_y_min, solar_x, col_solar_y_max, BLACK)
+                if col_usage_y_min != -1:
+                    # horizontally join the high points of the usage graph, if they exist. Flat joins are
+                    # collected into one run from run_x, which is drawn as a single line when the usage changes
+                    joined = last_x == col_x - 1 or last_x == col_x - 2
+                    if joined and col_usage_y_max == last_usage_y:
+                        if run_x is None:
+                            run_x = last_x
+                    else:
+                        if run_x is not None:
+                            line(run_x, last_usage_y, last_x, last_usage_y, BLACK)
+                            run_x = None
+                        if joined:
+                            line(last_x, last_usage_y, col_x, col_usage_y_max, BLACK)
+                    if col_usage_y_min != col_usage_y_max:
+                        line(col_x, col_usage_y_min, col_x, col_usage_y_max, BLACK)
+                    elif not joined:
+                        pixel(col_x, col_usage_y_min, BLACK)  # otherwise the join line covers this pixel
+                    last_x = col_x
+                    last_usage_y = col_usage_y_max
+            if x is None:
+                break
+            col_x = x
+            col_solar_y_min = buf_y[j]
+            col_solar_y_max = buf_y[j + 1]
+            col_usage_y_min = buf_y[j + 2]
+            col_usage_y_max = buf_y[j + 3]
+        if run_x is not None:
+            line(run_x, last_usage_y, last_x, last_usage_y, BLACK)
+        self.last_x = last_x
+        self.last_usage_y = last_usage_y
+        if newest is not None and (self._last_drawn_bucket is None or newest > self._last_drawn_bucket):
+            self._last_drawn_bucket = newest
+        print('Drawing {} columns'.format(num_drawn))
+        if num_drawn:
+            self._dirty = True
+
+
+def _uri_encode_byte(c):
+    if (ord('A') <= c <= ord('Z')) or (ord('a') <= c <= ord('z')) \
+       or (ord('0') <= c <= ord('9')) or c in b'-_.~':
+        return bytes([c])
+    return '%{:02x}'.format(c).encode()
+
+
+_URI_TABLE = tuple(_uri_encode_byte(c) for c in range(256))  # encoded bytes for each byte value
 
 
 def uri_encode(seq):
-    resp = b''
-    for c in seq.encode():
-        if (ord(b'A') <= c <= ord('Z')) or (ord(b'a') <= c <= ord(b'z')) \
-           or (ord(b'0') <= c <= ord(b'9')) or c in b'-_.~':
-            resp += chr(c)
-        else:
-            resp += b'%{:02x}'.format(c)
-    return resp
+    table = _URI_TABLE
+    return b''.join(table[c] for c in seq.encode())
+
+
+# Only the 'since' part of the InfluxDB query changes between polls, so the rest is encoded once here
+_QUERY_PREFIX = b'q=' + uri_encode('SELECT min(solar),max(solar),max(load)*-1,min(load)*-1 from power where time > ')
+_QUERY_SUFFIX = uri_encode(' group by time({}s) fill(none)'.format(Graph.SECONDS_PER_PIXEL))
 
 
 def main():
@@ -308,65 +634,127 @@ def main():
     ugfx.string(WIDTH//2 - 50, HEIGHT//2 - 11, 'Solarising...', 'Roboto_Regular22', ugfx.BLACK)
     ugfx.flush()
 
-    samples = []
     start = 'now() - {}s'.format(Graph.WIDTH_SECONDS)
-    while not samples:
+    failures = 0
+    while True:
         samples = query_data(influxdb_url, start)
-        print("got {} initial samples".format(len(samples)))
+        if samples:
+            break
+        if samples is None:
+            failures += 1
+        else:
+            print("got no initial samples")
+        utime.sleep(poll_delay(failures))
+    print("got {} initial samples".format(len(samples)))
+    failures = 0
 
-    last_sample = samples[0]
-    samples[-1].update_time()
+    last_ts = samples.ts[0]
+    update_time(samples.ts[-1])
 
     numbers = NumberDisplay()
     graph = Graph()
     while True:
         if samples:
-            if samples[-1].ts > last_sample.ts:
-                numbers.update(samples[-1])
-            elif unix_time() - last_sample.ts > 30:
+            if samples.ts[-1] > last_ts:
+                numbers.update(samples, -1)
+            elif unix_time() - last_ts > 30:
                 numbers.update_no_sample()
             graph.update(samples)
 
-            last_sample = samples[-1]
-            last_sample.update_time()
+            last_ts = samples.ts[-1]
+            update_time(last_ts)
+        else:
+            graph.update_no_sample()
 
-        utime.sleep(5)
-        samples = query_data(influxdb_url, last_sample.ts)
-        print('got {} samples'.format(len(samples)))
+        utime.sleep(poll_delay(failures))
+        samples = query_data(influxdb_url, last_ts)
+        if samples is None:
+            failures += 1
+            print('{} failed queries in a row'.format(failures))
+        else:
+            failures = 0
+            print('got {} samples'.format(len(samples)))
 
 
 def query_data(influxdb_url, since):
-    # returns list of Sample objects for all samples received in InfluxDB since 'since' timestamp
+    # returns Samples for all samples received in InfluxDB since 'since' timestamp, or None if the query failed
 
     if isinstance(since, int):
-        since = '{}s'.format(since)
+        since = '{}s'.format(since).encode()  # digits and 's' don't need encoding
+    else:
+        since = uri_encode(since)
 
-    result = []
+    result = Samples()
 
-    query = uri_encode('SELECT min(solar),max(solar),max(load)*-1,min(load)*-1 from power where '
-                       'time > {} group by time({}s) fill(none)'.format(since, Graph.SECONDS_PER_PIXEL))
+    query = _QUERY_PREFIX + since + _QUERY_SUFFIX
 
     try:
         resp = urequests.post('{}/query?db=sensors&epoch=s'.format(influxdb_url),
-                              data=b'q='+query,
+                              data=query,
                               headers=INFLUXDB_HEADERS)
     except OSError as e:
         print("Failed to connect to InfluxDB server")
         print(e)
-        return []
+        return None
 
     if resp.status_code != 200:
         print("InfluxDB returned error code {}".format(resp.status_code))
         resp.close()
-        return []
+        return None
 
-    data = json.load(resp.raw)
+    try:
+        parse_values(resp.raw, result)
+    except OSError as e:
+        print("Failed reading InfluxDB response")
+        print(e)
     resp.close()
     gc.collect()
-    result = [Sample(*x) for x in data['results'][0]['series'][0]['values']]
-    result = [s for s in result if not s.is_empty()]   # remove all the empty samples
     return result
 
 
+_VALUES_KEY = b'"values":'
+_READ_CHUNK = 256
+
+
+def parse_values(stream, result):
+    # Scan an InfluxDB JSON response for the "values" rows of the first series and append each non-empty row
+    # to result, reading the stream a chunk at a time instead of loading the whole JSON document.
+    buf = b''
+    pos = -1
+    while pos < 0:
+        chunk = stream.read(_READ_CHUNK)
+        if not chunk:
+            return  # no series in the response, ie no new data
+        buf = buf[-len(_VALUES_KEY):] + chunk  # keep enough in case the key is split across chunks
+        pos = buf.find(_VALUES_KEY)
+    pos += len(_VALUES_KEY)
+
+    while True:
+        end = buf.find(b']', pos)
+        if end < 0:
+            chunk = stream.read(_READ_CHUNK)
+            if not chunk:
+                print("InfluxDB response truncated")
+                return
+            buf = buf[pos:] + chunk  # only compact the buffer when reading more
+            pos = 0
+            continue
+        start = buf.rfind(b'[', pos, end)
+        if start < 0:
+            return  # this ']' closes the values array
+        fields = buf[start + 1:end].decode().split(',')
+        pos = end + 1
+        try:
+            if len(fields) != 5:
+                raise ValueError(fields)
+            # ts has to be parsed as an int, single precision floats can't hold it
+            row = [int(fields[0])] + [None if v.strip() == 'null' else float(v) for v in fields[1:]]
+        except ValueError as e:
+            print("Bad InfluxDB row {}".format(e))
+            continue
+        if not is_empty(row[1], row[3], row[4]):  # skip all the empty samples
+            result.append(*row)
+
+
 if __name__ == '__main__':
     main()